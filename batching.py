@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import weakref
+from typing import Any, Callable, List
+
+
+class MicroBatcher:
+    """
+    Group items submitted by concurrent requests into batches.
+
+    A batch is dispatched once max_batch items have arrived or max_latency_ms
+    has passed since the first one, whichever comes first. batch_fn receives
+    the list of items, must return one result per item, and runs in the
+    default thread pool so the event loop stays responsive. Each event loop
+    gets its own queue and worker, so the batcher can be shared by threads
+    that each run their own loop (e.g. via asyncio.run).
+    """
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], max_batch: int = 8,
+                 max_latency_ms: float = 15):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self._workers = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _queue_for(self, loop: asyncio.AbstractEventLoop) -> asyncio.Queue:
+        """Return this loop's queue, starting its worker if needed"""
+        with self._lock:
+            queue, worker = self._workers.get(loop, (None, None))
+            if worker is None or worker.done():
+                queue = asyncio.Queue()
+                worker = loop.create_task(self._consume(queue))
+                # The task references its loop, which would keep the weak key
+                # alive forever; drop the entry once the worker stops (e.g. when
+                # asyncio.run cancels it on shutdown)
+                worker.add_done_callback(lambda task: self._forget(loop, task))
+                self._workers[loop] = (queue, worker)
+            return queue
+
+    def _forget(self, loop: asyncio.AbstractEventLoop, worker: asyncio.Task):
+        """Drop loop's entry if worker is still the one registered for it"""
+        with self._lock:
+            entry = self._workers.get(loop)
+            if entry is not None and entry[1] is worker:
+                del self._workers[loop]
+
+    async def submit(self, item: Any) -> Any:
+        """Queue one item and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self._queue_for(loop).put((item, future))
+        return await future
+
+    async def _consume(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            try:
+                deadline = loop.time() + self.max_latency
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                items = [item for item, _ in batch]
+                results = await loop.run_in_executor(None, self.batch_fn, items)
+                if len(results) != len(batch):
+                    raise RuntimeError(f"batch_fn returned {len(results)} results for {len(batch)} items")
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -1,16 +1,23 @@
 from transformers import pipeline
 from typing import List, Dict, Tuple
 import re
-from question_answering import extract_context, highlight_text
+import threading
+from question_answering import extract_context, highlight_text, run_qa_pipeline
 
 
-generator = pipeline("text-generation", model="gpt2", device=-1)  # Use CPU
+# GPT-2 loads in a background thread so importing this module doesn't block
+# app startup; generate_questions waits on _generator_ready before using it
+_generator_ready = threading.Event()
+generator = None
 
-qa_pipeline = pipeline(
-    "question-answering",
-    model="distilbert-base-cased-distilled-squad",
-    device=-1  # Use CPU
-)
+def _load_generator():
+    global generator
+    try:
+        generator = pipeline("text-generation", model="gpt2", device=-1)  # Use CPU
+    finally:
+        _generator_ready.set()
+
+threading.Thread(target=_load_generator, daemon=True).start()
 
 def find_relevant_context(document_text: str, question: str) -> Dict:
     """Find the most relevant context in the document for a given question"""
@@ -25,7 +32,7 @@ def find_relevant_context(document_text: str, question: str) -> Dict:
     for chunk in chunks:
         try:
             
-            result = qa_pipeline(
+            result = run_qa_pipeline(
                 question=question,
                 context=chunk['text'],
                 max_answer_len=150,
@@ -55,6 +62,11 @@ def generate_questions(document_text: str) -> List[Dict]:
     key_chunks = chunks[:3]
     questions = []
     
+    # Without the generator, fall through to the default questions below
+    _generator_ready.wait()
+    if generator is None:
+        key_chunks = []
+    
     for chunk in key_chunks:
         try:
             
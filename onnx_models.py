@@ -0,0 +1,127 @@
+import glob
+import mmap
+import os
+import shutil
+import tempfile
+from typing import List, Optional
+
+import onnxruntime as ort
+from optimum.onnxruntime import ORTOptimizer, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig, OptimizationConfig
+
+
+# Exported, optimized and quantized models are cached here so the export only runs once
+ONNX_CACHE_DIR = os.environ.get("ONNX_CACHE_DIR", ".onnx_cache")
+
+def available_cpu_count() -> int:
+    """Number of CPUs this process may run on, respecting affinity masks (taskset, cpusets)"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+def session_options(intra_op_num_threads: Optional[int] = None) -> ort.SessionOptions:
+    """
+    Build ONNX Runtime session options tuned for CPU inference.
+    Callers that run the session from several threads should pass a
+    smaller intra_op_num_threads to avoid oversubscribing the CPU.
+    """
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.enable_mem_pattern = True
+    options.enable_cpu_mem_arena = True
+    # 0 lets ORT pick one thread per physical core within the process's affinity
+    options.intra_op_num_threads = intra_op_num_threads or 0
+    return options
+
+def prefetch_weights(model_dir: str):
+    """
+    Ask the kernel to read a model's ONNX files into the page cache ahead
+    of loading, turning scattered page faults into sequential readahead
+    """
+    if not hasattr(mmap, "MADV_WILLNEED"):
+        return
+    for path in glob.glob(os.path.join(model_dir, "*.onnx*")):
+        if os.path.getsize(path) == 0:
+            continue
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+            mm.madvise(mmap.MADV_WILLNEED)
+
+def quantized_file_name(file_name: str) -> str:
+    """Name ORTQuantizer gives the INT8 copy of an exported ONNX file"""
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}_quantized{ext}"
+
+def optimized_file_name(file_name: str) -> str:
+    """Name ORTOptimizer gives the graph-optimized copy of an exported ONNX file"""
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}_optimized{ext}"
+
+def _build_dir(final_dir: str, build) -> str:
+    """
+    Create final_dir by running build(tmp_dir) on a scratch directory next to it
+    and renaming that into place once every file is written. An interrupted or
+    failed build never leaves a partial final_dir that later runs would trust,
+    and concurrent processes can't see each other's half-written files.
+    """
+    if os.path.isdir(final_dir):
+        return final_dir
+    
+    parent = os.path.dirname(final_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(final_dir) + ".", suffix=".tmp", dir=parent)
+    try:
+        build(tmp_dir)
+        try:
+            os.replace(tmp_dir, final_dir)
+        except OSError:
+            # Another process finished the same build first
+            if not os.path.isdir(final_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return final_dir
+
+def _export_model(model_class, model_id: str, **kwargs) -> str:
+    """Export a Hugging Face model to ONNX once and return the export directory"""
+    def build(tmp_dir):
+        model = model_class.from_pretrained(model_id, export=True, **kwargs)
+        model.save_pretrained(tmp_dir)
+    
+    return _build_dir(os.path.join(ONNX_CACHE_DIR, model_id.replace("/", "--")), build)
+
+def quantize_model(model_class, model_id: str, file_names: List[str], **kwargs) -> str:
+    """
+    Export a Hugging Face model to ONNX and apply INT8 dynamic quantization
+    to each of its ONNX files. Returns the directory holding the quantized
+    model; the work is skipped if that directory already exists.
+    """
+    export_dir = _export_model(model_class, model_id, **kwargs)
+    
+    def build(tmp_dir):
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=True)
+        for file_name in file_names:
+            quantizer = ORTQuantizer.from_pretrained(export_dir, file_name=file_name)
+            quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+    
+    return _build_dir(export_dir + "-int8", build)
+
+def optimize_model(model_class, model_id: str, file_names: List[str], **kwargs) -> str:
+    """
+    Export a Hugging Face model to ONNX and apply offline transformer graph
+    fusions (attention, LayerNorm, GELU) while keeping FP32 weights. This is
+    the fallback for models whose accuracy suffers under INT8 quantization.
+    Returns the directory holding the optimized model.
+    """
+    export_dir = _export_model(model_class, model_id, **kwargs)
+    
+    def build(tmp_dir):
+        config = OptimizationConfig(
+            optimization_level=99,
+            fp16=False,
+            enable_transformers_specific_optimizations=True
+        )
+        optimizer = ORTOptimizer.from_pretrained(export_dir, file_names=file_names)
+        optimizer.optimize(save_dir=tmp_dir, optimization_config=config)
+    
+    return _build_dir(export_dir + "-optimized", build)
@@ -1,66 +1,395 @@
-from transformers import pipeline
-from typing import Dict, List, Tuple
+from transformers import AutoModelForQuestionAnswering, AutoTokenizer, pipeline
+from optimum.onnxruntime import ORTModelForQuestionAnswering
+from cachetools import LRUCache, cached
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import os
 import re
+import threading
+import torch
 
-
-qa_pipeline = pipeline(
-    "question-answering",
-    model="distilbert-base-cased-distilled-squad",
-    device=-1  
+from batching import MicroBatcher
+from onnx_models import (
+    available_cpu_count, optimize_model, optimized_file_name, prefetch_weights, quantize_model,
+    quantized_file_name, session_options
 )
+from utils import DEVICE, DTYPE, USE_CUDA, document_hash
+
+
+QA_MODEL = "distilbert-base-cased-distilled-squad"
+QA_WORKERS = 4
+QA_BATCH_SIZE = 32 if USE_CUDA else 8
+# Number of top-ranked chunks evaluated before deciding whether to search the rest
+QA_FIRST_WAVE = 2
+# Answers scoring at least this in the first wave skip the remaining chunks
+QA_SCORE_THRESHOLD = 0.85
+# On CPU: "int8" for the dynamically quantized model, or "fp32" for the graph-optimized
+# full precision model if quantization costs too much accuracy
+QA_PRECISION = os.environ.get("QA_PRECISION", "int8").strip().lower()
+if QA_PRECISION not in ("int8", "fp32"):
+    raise ValueError(f"QA_PRECISION must be 'int8' or 'fp32', got {QA_PRECISION!r}")
+
+# Models load in a background thread so importing this module doesn't block
+# app startup; callers wait on _qa_ready before touching them
+_qa_ready = threading.Event()
+qa_model = None
+qa_tokenizer = None
+qa_pipeline = None
+# qa_tokenizer's truncation settings live in shared Rust state, which
+# raises "Already borrowed" if two threads reconfigure it at the same time
+_tokenizer_lock = threading.Lock()
+
+def _load_tokenizer():
+    """Load a Rust-backed fast tokenizer for the QA model"""
+    return AutoTokenizer.from_pretrained(
+        QA_MODEL,
+        use_fast=True,
+        model_max_length=512,
+        padding_side="right",
+        truncation_side="right"
+    )
+
+def _load_qa_model():
+    """
+    Load DistilBERT into the module globals: the FP16 PyTorch model on a CUDA
+    GPU when available, otherwise the ONNX export on CPU
+    """
+    global qa_model, qa_tokenizer, qa_pipeline
+    try:
+        if USE_CUDA:
+            model = AutoModelForQuestionAnswering.from_pretrained(QA_MODEL, torch_dtype=DTYPE)
+            model = model.to(DEVICE).eval()
+        else:
+            if QA_PRECISION == "fp32":
+                model_dir = optimize_model(ORTModelForQuestionAnswering, QA_MODEL, ["model.onnx"])
+                file_name = optimized_file_name("model.onnx")
+            else:
+                model_dir = quantize_model(ORTModelForQuestionAnswering, QA_MODEL, ["model.onnx"])
+                file_name = quantized_file_name("model.onnx")
+            prefetch_weights(model_dir)
+            model = ORTModelForQuestionAnswering.from_pretrained(
+                model_dir,
+                file_name=file_name,
+                # _run_batches overlaps up to QA_WORKERS Run calls on this session,
+                # so split the cores between them instead of oversubscribing
+                session_options=session_options(
+                    intra_op_num_threads=max(1, available_cpu_count() // QA_WORKERS)
+                ),
+                provider="CPUExecutionProvider"
+            )
+        # The pipeline gets its own tokenizer so its calls never contend with
+        # find_best_answer's use of qa_tokenizer
+        tokenizer = _load_tokenizer()
+        qa_pipeline = pipeline(
+            "question-answering",
+            model=model,
+            tokenizer=_load_tokenizer(),
+            framework="pt",
+            device=DEVICE if USE_CUDA else None
+        )
+        qa_model, qa_tokenizer = model, tokenizer
+    finally:
+        _qa_ready.set()
+
+def _wait_for_qa_model():
+    """Block until the background load has finished"""
+    _qa_ready.wait()
+    if qa_model is None:
+        raise RuntimeError(f"Failed to load QA model {QA_MODEL}")
+
+def run_qa_pipeline(**kwargs) -> Dict:
+    """
+    Run the shared question-answering pipeline once the background load has
+    finished
+    """
+    _wait_for_qa_model()
+    return qa_pipeline(**kwargs)
+
+threading.Thread(target=_load_qa_model, daemon=True).start()
 
 def extract_context(document_text: str, max_chars: int = 4000) -> List[Dict]:
     """Split document into chunks with overlapping context"""
-    words = document_text.split()
+    # (start, end) offsets of every whitespace-delimited word in the document
+    spans = [m.span() for m in re.finditer(r'\S+', document_text)]
     chunks = []
     chunk_size = 1000  
     overlap = 200      
     
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = ' '.join(words[i:i + chunk_size])
+    step = chunk_size - overlap
+    for i in range(0, len(spans), step):
+        start = spans[i][0]
+        end = spans[min(i + chunk_size, len(spans)) - 1][1]
         chunks.append({
-            'text': chunk,
-            'start': sum(len(w) + 1 for w in words[:i]),  
-            'end': sum(len(w) + 1 for w in words[:i + len(chunk.split())])
+            'text': document_text[start:end],
+            'start': start,
+            'end': end
         })
     
     return chunks
 
-def find_best_answer(document_text: str, question: str) -> Dict:
-    """Find the best answer from the document"""
-    chunks = extract_context(document_text)
-    best_score = 0
-    best_answer = {
+def _encode_chunks(question_ids: List[int], chunks: List[Dict], max_seq_len: int = 512,
+                   doc_stride: int = 128) -> List[Dict]:
+    """
+    Build model features for every chunk, reusing the already tokenized question.
+    Long chunks are split into overlapping windows of context tokens.
+    """
+    max_context_len = max_seq_len - len(question_ids) - 3
+    context_offset = len(question_ids) + 2
+    prefix = [qa_tokenizer.cls_token_id] + question_ids + [qa_tokenizer.sep_token_id]
+    
+    with _tokenizer_lock:
+        encoded = qa_tokenizer(
+            [chunk['text'] for chunk in chunks],
+            add_special_tokens=False,
+            truncation=True,
+            max_length=max_context_len,
+            stride=doc_stride,
+            return_overflowing_tokens=True,
+            return_offsets_mapping=True
+        )
+    
+    features = []
+    for chunk_index, context_ids, offsets in zip(
+        encoded['overflow_to_sample_mapping'], encoded['input_ids'], encoded['offset_mapping']
+    ):
+        features.append({
+            'input_ids': prefix + context_ids + [qa_tokenizer.sep_token_id],
+            'context_offset': context_offset,
+            'offsets': offsets,
+            'chunk': chunks[chunk_index]
+        })
+    
+    return features
+
+def _run_model(features: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """Run one padded batch of features through the QA model"""
+    seq_len = max(len(f['input_ids']) for f in features)
+    input_ids = np.full((len(features), seq_len), qa_tokenizer.pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(features), seq_len), dtype=np.int64)
+    for row, feature in enumerate(features):
+        input_ids[row, :len(feature['input_ids'])] = feature['input_ids']
+        attention_mask[row, :len(feature['input_ids'])] = 1
+    
+    if USE_CUDA:
+        with torch.inference_mode():
+            outputs = qa_model(
+                input_ids=torch.from_numpy(input_ids).to(DEVICE),
+                attention_mask=torch.from_numpy(attention_mask).to(DEVICE)
+            )
+        return outputs.start_logits.float().cpu().numpy(), outputs.end_logits.float().cpu().numpy()
+    
+    outputs = qa_model(input_ids=input_ids, attention_mask=attention_mask)
+    return np.asarray(outputs.start_logits), np.asarray(outputs.end_logits)
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    exp = np.exp(logits - logits.max())
+    return exp / exp.sum()
+
+def _best_span(start_logits: np.ndarray, end_logits: np.ndarray, context_offset: int,
+               context_len: int, max_answer_len: int = 150) -> Tuple[int, int, float]:
+    """Pick the highest scoring (start, end) token span inside the context"""
+    if context_len == 0:
+        return (0, 0, 0.0)
+    
+    start_probs = _softmax(start_logits[context_offset:context_offset + context_len])
+    end_probs = _softmax(end_logits[context_offset:context_offset + context_len])
+    
+    # Score every span at once, zeroing spans that end before they start
+    # or run longer than max_answer_len
+    scores = np.triu(np.tril(np.outer(start_probs, end_probs), max_answer_len - 1))
+    s, e = divmod(int(scores.argmax()), context_len)
+    return (s, e, float(scores[s, e]))
+
+_WORD_RE = re.compile(r'\w+')
+
+@cached(LRUCache(maxsize=32), key=lambda document_text: document_hash(document_text), lock=threading.Lock())
+def _indexed_chunks(document_text: str) -> List[Tuple[Dict, frozenset]]:
+    """Chunks of a document paired with their lowercase word sets, cached per document"""
+    return [
+        (chunk, frozenset(_WORD_RE.findall(chunk['text'].lower())))
+        for chunk in extract_context(document_text)
+    ]
+
+def _rank_chunks(document_text: str, question: str) -> List[Dict]:
+    """Order chunks by how many of the question's words they contain"""
+    question_words = set(_WORD_RE.findall(question.lower()))
+    ranked = sorted(_indexed_chunks(document_text), key=lambda item: -len(question_words & item[1]))
+    return [chunk for chunk, _ in ranked]
+
+def _run_batches(batches: List[List[Dict]]) -> List[Tuple[List[Dict], object]]:
+    """
+    Run feature batches through the model, pairing each batch with its
+    (start_logits, end_logits) or with the exception it raised. Several batches
+    are overlapped on a pool, since ONNX Runtime releases the GIL while running;
+    the CPU session's intra-op threads are sized for QA_WORKERS concurrent runs.
+    """
+    def run(batch):
+        try:
+            return _run_model(batch)
+        except Exception as e:
+            return e
+    
+    if len(batches) <= 1:
+        return [(batch, run(batch)) for batch in batches]
+    workers = min(QA_WORKERS, len(batches), available_cpu_count())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(zip(batches, executor.map(run, batches)))
+
+def _empty_answer() -> Dict:
+    return {
         'answer': "I couldn't find a clear answer in the document.",
         'score': 0,
         'start': 0,
         'end': 0,
         'context': ""
     }
+
+def _span_answer(feature: Dict, start_logits: np.ndarray, end_logits: np.ndarray) -> Dict:
+    """Decode the best span of one feature into an answer dict"""
+    s, e, score = _best_span(start_logits, end_logits, feature['context_offset'], len(feature['offsets']))
+    if score <= 0:
+        return _empty_answer()
+    chunk = feature['chunk']
+    char_start = feature['offsets'][s][0]
+    char_end = feature['offsets'][e][1]
+    return {
+        'answer': chunk['text'][char_start:char_end],
+        'score': score,
+        'start': char_start,
+        'end': char_end,
+        'context': chunk['text']
+    }
+
+def _tokenize_question(question: str) -> List[int]:
+    with _tokenizer_lock:
+        return qa_tokenizer(question, add_special_tokens=False)['input_ids'][:100]
+
+# Answers keyed by (document hash, question, score threshold). Filled by hand
+# rather than with @cached so that results from failed model runs aren't kept.
+_answer_cache = LRUCache(maxsize=512)
+_answer_cache_lock = threading.Lock()
+
+def _answer_key(document_text: str, question: str, score_threshold: float) -> Tuple:
+    return (document_hash(document_text), question, score_threshold)
+
+def _cached_answer(key: Tuple) -> Optional[Dict]:
+    """Return a copy of a cached answer, so callers can't edit the cached entry"""
+    with _answer_cache_lock:
+        answer = _answer_cache.get(key)
+    return dict(answer) if answer is not None else None
+
+def _finish_answer(key: Tuple, answer: Dict, errors: List[Exception], succeeded: int) -> Dict:
+    """
+    Cache and return a search result. A failed model run says nothing about the
+    document, so results with errors are not cached and the search runs again
+    next time; if nothing ran successfully the error is raised instead.
+    """
+    if errors:
+        if not succeeded:
+            raise errors[-1]
+        return answer
+    
+    with _answer_cache_lock:
+        _answer_cache[key] = answer
+    return dict(answer)
+
+def _search_answers(requests: List[Tuple[str, str]], batch_size: int,
+                    score_threshold: float) -> List[Tuple[Dict, List[Exception], int]]:
+    """
+    Answer several (document_text, question) pairs, packing the features of
+    every request into shared forward passes. Each request's QA_FIRST_WAVE
+    best-ranked chunks run first; its remaining chunks only run if none of
+    those scored at least score_threshold. Returns, per request, the best
+    answer, the errors it hit and how many of its batches ran successfully.
+    """
+    _wait_for_qa_model()
+    states = [{'answer': _empty_answer(), 'errors': [], 'succeeded': 0, 'chunks': []} for _ in requests]
     
-    for chunk in chunks:
+    for state, (document_text, question) in zip(states, requests):
         try:
-            result = qa_pipeline(
-                question=question,
-                context=chunk['text'],
-                max_answer_len=150,
-                max_question_len=100,
-                max_seq_len=512
-            )
-            
-            
-            result['start'] += chunk['start']
-            result['end'] += chunk['start']
-            result['context'] = chunk['text']
-            
-            if result['score'] > best_score:
-                best_score = result['score']
-                best_answer = result
+            state['chunks'] = _rank_chunks(document_text, question)
+            if state['chunks']:
+                # The question is identical for every chunk, so tokenize it only once
+                state['question_ids'] = _tokenize_question(question)
         except Exception as e:
-            print(f"Error processing chunk: {e}")
-            continue
+            print(f"Error preparing question: {e}")
+            state['errors'].append(e)
+            state['chunks'] = []
     
-    return best_answer
+    for first_wave in (True, False):
+        features = []
+        for index, state in enumerate(states):
+            if first_wave:
+                wave = state['chunks'][:QA_FIRST_WAVE]
+            elif state['answer']['score'] < score_threshold:
+                wave = state['chunks'][QA_FIRST_WAVE:]
+            else:
+                wave = []
+            if not wave:
+                continue
+            try:
+                encoded = _encode_chunks(state['question_ids'], wave)
+            except Exception as e:
+                print(f"Error processing chunks: {e}")
+                state['errors'].append(e)
+                continue
+            for feature in encoded:
+                feature['request'] = index
+                features.append(feature)
+        
+        batches = [features[i:i + batch_size] for i in range(0, len(features), batch_size)]
+        for batch, outputs in _run_batches(batches):
+            batch_requests = {feature['request'] for feature in batch}
+            if isinstance(outputs, Exception):
+                print(f"Error processing chunks: {outputs}")
+                for index in batch_requests:
+                    states[index]['errors'].append(outputs)
+                continue
+            
+            for index in batch_requests:
+                states[index]['succeeded'] += 1
+            start_logits, end_logits = outputs
+            for row, feature in enumerate(batch):
+                state = states[feature['request']]
+                answer = _span_answer(feature, start_logits[row], end_logits[row])
+                if answer['score'] > state['answer']['score']:
+                    state['answer'] = answer
+    
+    return [(state['answer'], state['errors'], state['succeeded']) for state in states]
+
+def find_best_answer(document_text: str, question: str, batch_size: int = QA_BATCH_SIZE,
+                     score_threshold: float = QA_SCORE_THRESHOLD) -> Dict:
+    """
+    Find the best answer from the document. The QA_FIRST_WAVE chunks sharing
+    the most words with the question are evaluated first, and the remaining
+    chunks are skipped if one of them scores at least score_threshold.
+    """
+    key = _answer_key(document_text, question, score_threshold)
+    cached_answer = _cached_answer(key)
+    if cached_answer is not None:
+        return cached_answer
+    
+    answer, errors, succeeded = _search_answers([(document_text, question)], batch_size, score_threshold)[0]
+    return _finish_answer(key, answer, errors, succeeded)
+
+def _find_best_answers(requests: List[Tuple[str, str]]) -> List[object]:
+    """
+    Batch function behind ask_question_async. Returns, per request, the same
+    answer find_best_answer would give, or the exception that request raised,
+    so one bad request doesn't fail the others in its micro-batch.
+    """
+    results = []
+    searched = _search_answers(requests, QA_BATCH_SIZE, QA_SCORE_THRESHOLD)
+    for (document_text, question), (answer, errors, succeeded) in zip(requests, searched):
+        try:
+            key = _answer_key(document_text, question, QA_SCORE_THRESHOLD)
+            results.append(_finish_answer(key, answer, errors, succeeded))
+        except Exception as e:
+            results.append(e)
+    return results
+
+_qa_batcher = MicroBatcher(_find_best_answers, max_batch=8, max_latency_ms=15)
 
 def highlight_text(text: str, start: int, end: int, window: int = 100) -> str:
     """Highlight the relevant part of the text"""
@@ -77,41 +406,34 @@ def highlight_text(text: str, start: int, end: int, window: int = 100) -> str:
     
     return excerpt.strip()
 
+_TRANSFORMER_RE = re.compile(r'\btransformers?\b', re.IGNORECASE)
+
+_TRANSFORMER_ANSWER = {
+    'answer': (
+        "A transformer is a deep learning model architecture introduced in the paper 'Attention Is All You Need' "
+        "by Vaswani et al. in 2017. It's designed to handle sequential data (like text) using self-attention mechanisms "
+        "rather than traditional recurrent or convolutional layers.\n\n"
+        "Key features of transformers include:\n"
+        "• Self-attention mechanisms to weigh the importance of different parts of the input\n"
+        "• Parallel processing of sequence data (unlike RNNs which process sequentially)\n"
+        "• Positional encodings to account for word order\n"
+        "• Layer normalization and residual connections for stable training\n\n"
+        "Transformers have become fundamental in natural language processing and are the basis for models like BERT, GPT, and others."
+    ),
+    'context': "The document discusses technical details about transformers, including their architecture with encoder-decoder structure, multi-head attention mechanisms, and layer normalization.",
+    'highlight': "transformer",
+    'confidence': 95.0,
+    'is_comprehensive': True
+}
+
 def get_comprehensive_answer(document_text: str, question: str) -> Dict:
     """Generate a comprehensive answer for broad questions about key concepts"""
-    question_lower = question.lower()
-    
-    is_about_transformers = ('transformer' in question_lower or 
-                           'transformers' in question_lower or
-                           'what is a transformer' in question_lower or
-                           'what are transformers' in question_lower or
-                           'explain transformer' in question_lower)
-    
-    if is_about_transformers:
-        return {
-            'answer': (
-                "A transformer is a deep learning model architecture introduced in the paper 'Attention Is All You Need' "
-                "by Vaswani et al. in 2017. It's designed to handle sequential data (like text) using self-attention mechanisms "
-                "rather than traditional recurrent or convolutional layers.\n\n"
-                "Key features of transformers include:\n"
-                "• Self-attention mechanisms to weigh the importance of different parts of the input\n"
-                "• Parallel processing of sequence data (unlike RNNs which process sequentially)\n"
-                "• Positional encodings to account for word order\n"
-                "• Layer normalization and residual connections for stable training\n\n"
-                "Transformers have become fundamental in natural language processing and are the basis for models like BERT, GPT, and others."
-            ),
-            'context': "The document discusses technical details about transformers, including their architecture with encoder-decoder structure, multi-head attention mechanisms, and layer normalization.",
-            'highlight': "transformer",
-            'confidence': 95.0,  
-            'is_comprehensive': True
-        }
+    if _TRANSFORMER_RE.search(question):
+        return dict(_TRANSFORMER_ANSWER)
     return None
 
-def ask_question(document_text: str, user_question: str) -> Dict:
-    """
-    Answer a question based on the document text
-    Returns a dictionary with answer and metadata
-    """
+def _early_answer(document_text: str, user_question: str) -> Optional[Dict]:
+    """Answers that don't need the QA model, or None if the model should run"""
     if not document_text.strip():
         return {
             'answer': "No document text provided.",
@@ -122,56 +444,83 @@ def ask_question(document_text: str, user_question: str) -> Dict:
             'is_comprehensive': False
         }
     
-    comprehensive_answer = get_comprehensive_answer(document_text, user_question)
-    if comprehensive_answer:
-        return comprehensive_answer
-    
-    try:
+    return get_comprehensive_answer(document_text, user_question)
 
-        result = find_best_answer(document_text, user_question)
-        
-  
-        answer = result.get('answer', "I couldn't find a clear answer in the document.")
-        start = result.get('start', 0)
-        end = result.get('end', len(answer))
+def _format_answer(document_text: str, result: Dict) -> Dict:
+    """Turn a find_best_answer result into the response shown to the user"""
+    answer = result.get('answer', "I couldn't find a clear answer in the document.")
+    context = result.get('context', '')
+    
+    if context:
+        # start/end are offsets of the answer within the returned context
+        pos = result.get('start')
+        end = result.get('end')
+        if pos is None or end is None:
+            # Answers keep the source casing, so an exact search usually hits
+            pos = context.find(answer)
+            end = pos + len(answer)
+            if pos < 0:
+                match = re.search(re.escape(answer), context, re.IGNORECASE)
+                pos, end = (match.start(), match.end()) if match else (-1, -1)
         
-        context = result.get('context', '')
-        if not context and 'context' in result:
-            context = result['context']
-   
-        if context:
-            
-            answer_lower = answer.lower()
-            context_lower = context.lower()
-            pos = context_lower.find(answer_lower)
-            
-            if pos >= 0:
-               
-                actual_answer = context[pos:pos+len(answer)]
-                highlighted_context = (
-                    context[:pos] +
-                    f'<span class="highlight">{actual_answer}</span>' +
-                    context[pos+len(actual_answer):]
-                )
-            else:
-                highlighted_context = context
+        if pos >= 0:
+            highlighted_context = ''.join(
+                (context[:pos], '<span class="highlight">', context[pos:end], '</span>', context[end:])
+            )
         else:
             highlighted_context = context
-        
-        return {
-            'answer': answer,
-            'confidence': round(result.get('score', 0) * 100, 1),  
-            'context': highlighted_context or "No specific context found.",
-            'highlight': answer,
-            'full_context': context or document_text[:1000]  
-        }
-        
+    else:
+        highlighted_context = context
+    
+    return {
+        'answer': answer,
+        'confidence': round(result.get('score', 0) * 100, 1),  
+        'context': highlighted_context or "No specific context found.",
+        'highlight': answer,
+        'full_context': context or document_text[:1000]  
+    }
+
+def _error_answer(document_text: str, e: Exception) -> Dict:
+    return {
+        'answer': f"Error processing your question: {str(e)}",
+        'confidence': 0,
+        'context': "An error occurred while processing the document.",
+        'highlight': "",
+        'full_context': document_text[:1000]
+    }
+
+def ask_question(document_text: str, user_question: str) -> Dict:
+    """
+    Answer a question based on the document text
+    Returns a dictionary with answer and metadata
+    """
+    early_answer = _early_answer(document_text, user_question)
+    if early_answer:
+        return early_answer
+    
+    try:
+        return _format_answer(document_text, find_best_answer(document_text, user_question))
     except Exception as e:
         print(f"Error in ask_question: {str(e)}")
-        return {
-            'answer': f"Error processing your question: {str(e)}",
-            'confidence': 0,
-            'context': "An error occurred while processing the document.",
-            'highlight': "",
-            'full_context': document_text[:1000]
-        }
+        return _error_answer(document_text, e)
+
+async def ask_question_async(document_text: str, user_question: str) -> Dict:
+    """
+    Async version of ask_question for servers handling concurrent users.
+    Questions arriving within a few milliseconds of each other share
+    batched forward passes through the QA model.
+    """
+    early_answer = _early_answer(document_text, user_question)
+    if early_answer:
+        return early_answer
+    
+    try:
+        result = _cached_answer(_answer_key(document_text, user_question, QA_SCORE_THRESHOLD))
+        if result is None:
+            result = await _qa_batcher.submit((document_text, user_question))
+            if isinstance(result, Exception):
+                raise result
+        return _format_answer(document_text, result)
+    except Exception as e:
+        print(f"Error in ask_question_async: {str(e)}")
+        return _error_answer(document_text, e)
@@ -1,12 +1,157 @@
-from transformers import pipeline
+from cachetools import LRUCache
+from optimum.onnxruntime import ORTModelForSeq2SeqLM
+from transformers import AutoTokenizer, pipeline
+import math
+import threading
 
-summarizer = pipeline("summarization", model="facebook/bart-large-cnn")
+from batching import MicroBatcher
+from onnx_models import prefetch_weights, quantize_model, quantized_file_name, session_options
+from utils import DEVICE, DTYPE, USE_CUDA, document_hash
 
-def generate_summary(text):
-   
-    limited_text = text[:3000]
-    summary = summarizer(limited_text, max_length=150, min_length=50, do_sample=False)
+SUMMARY_MODEL = "sshleifer/distilbart-cnn-12-6"
+SUMMARY_ONNX_FILES = ["encoder_model.onnx", "decoder_model.onnx", "decoder_with_past_model.onnx"]
+
+# Beam search and large batches pay off on a GPU; on CPU greedy decoding is much faster
+GENERATION_OPTIONS = (
+    {"num_beams": 4, "batch_size": 32} if USE_CUDA else {"num_beams": 1, "batch_size": 4}
+)
+
+# Loaded in a background thread so importing this module doesn't block app startup
+_summarizer_ready = threading.Event()
+summarizer = None
+
+def _load_summarizer():
+    """
+    Load distilled BART: in FP16 on a CUDA GPU when available, otherwise
+    exported to ONNX with a KV cache and quantized to INT8 for the CPU
+    """
+    global summarizer
+    try:
+        if USE_CUDA:
+            summarizer = pipeline("summarization", model=SUMMARY_MODEL, device=DEVICE, torch_dtype=DTYPE)
+            return
+        
+        model_dir = quantize_model(ORTModelForSeq2SeqLM, SUMMARY_MODEL, SUMMARY_ONNX_FILES, use_cache=True)
+        prefetch_weights(model_dir)
+        summarizer = pipeline(
+            "summarization",
+            model=ORTModelForSeq2SeqLM.from_pretrained(
+                model_dir,
+                encoder_file_name=quantized_file_name(SUMMARY_ONNX_FILES[0]),
+                decoder_file_name=quantized_file_name(SUMMARY_ONNX_FILES[1]),
+                decoder_with_past_file_name=quantized_file_name(SUMMARY_ONNX_FILES[2]),
+                use_cache=True,
+                session_options=session_options(),
+                provider="CPUExecutionProvider"
+            ),
+            tokenizer=AutoTokenizer.from_pretrained(SUMMARY_MODEL)
+        )
+    finally:
+        _summarizer_ready.set()
+
+threading.Thread(target=_load_summarizer, daemon=True).start()
+
+def split_into_windows(text, max_input=1000, overlap=100):
+    """
+    Split text into overlapping windows that fit the summarizer's input length.
+    Windows are sized evenly so the last one isn't mostly overlap with the one
+    before it, which would force a min_length summary of a short tail.
+    """
+    tokenizer = summarizer.tokenizer
+    ids = tokenizer(text, add_special_tokens=False, truncation=False)["input_ids"]
+    if len(ids) <= max_input:
+        return [tokenizer.decode(ids, skip_special_tokens=True)]
+    
+    count = math.ceil((len(ids) - overlap) / (max_input - overlap))
+    size = math.ceil((len(ids) + (count - 1) * overlap) / count)
+    step = size - overlap
+    return [
+        tokenizer.decode(ids[k * step:k * step + size], skip_special_tokens=True)
+        for k in range(count)
+    ]
+
+def _summarize_windows(windows):
+    """Summarize the windows of several documents in one batched call"""
+    summaries = summarizer(
+        [chunk for chunks in windows for chunk in chunks],
+        max_length=150,
+        min_length=50,
+        do_sample=False,
+        early_stopping=True,
+        truncation=True,
+        **GENERATION_OPTIONS
+    )
+
+    results = []
+    position = 0
+    for chunks in windows:
+        parts = summaries[position:position + len(chunks)]
+        results.append(" ".join(s["summary_text"] for s in parts))
+        position += len(chunks)
+    return results
 
-    return summary[0]["summary_text"]
+def _summarize_batch(texts):
+    """
+    Summarize several documents with one batched pass over all of their windows.
+    Returns a summary, or the exception raised, for each text, so one bad
+    document doesn't fail the others in its batch.
+    """
+    _summarizer_ready.wait()
+    if summarizer is None:
+        raise RuntimeError(f"Failed to load summarization model {SUMMARY_MODEL}")
 
+    results = [None] * len(texts)
+    windows = {}
+    for index, text in enumerate(texts):
+        try:
+            windows[index] = split_into_windows(text)
+        except Exception as e:
+            results[index] = e
+
+    def summarize(indices):
+        try:
+            for index, summary in zip(indices, _summarize_windows([windows[i] for i in indices])):
+                results[index] = summary
+        except Exception as e:
+            if len(indices) == 1:
+                results[indices[0]] = e
+            else:
+                # Retry one by one to isolate the document that failed
+                for index in indices:
+                    summarize([index])
+
+    if windows:
+        summarize(list(windows))
+    return results
+
+_summary_batcher = MicroBatcher(_summarize_batch, max_batch=8, max_latency_ms=15)
+
+# Summaries keyed by document hash; only successful summaries are stored
+_summary_cache = LRUCache(maxsize=512)
+_summary_cache_lock = threading.Lock()
+
+def _cached_summary(key):
+    with _summary_cache_lock:
+        return _summary_cache.get(key)
+
+def _finish_summary(key, summary):
+    if isinstance(summary, Exception):
+        raise summary
+    with _summary_cache_lock:
+        _summary_cache[key] = summary
+    return summary
+
+def generate_summary(text):
+    key = document_hash(text)
+    summary = _cached_summary(key)
+    if summary is None:
+        summary = _finish_summary(key, _summarize_batch([text])[0])
+    return summary
 
+async def generate_summary_async(text):
+    """Async version of generate_summary that batches concurrent requests together"""
+    key = document_hash(text)
+    summary = _cached_summary(key)
+    if summary is None:
+        summary = _finish_summary(key, await _summary_batcher.submit(text))
+    return summary
@@ -0,0 +1,77 @@
+import asyncio
+import gc
+import threading
+import unittest
+
+from batching import MicroBatcher
+
+
+def double(items):
+    if "bad" in items:
+        raise ValueError("bad item")
+    return [item * 2 for item in items]
+
+
+class MicroBatcherTest(unittest.TestCase):
+    def test_groups_concurrent_items(self):
+        sizes = []
+
+        def batch_fn(items):
+            sizes.append(len(items))
+            return double(items)
+
+        batcher = MicroBatcher(batch_fn, max_batch=4, max_latency_ms=50)
+
+        async def main():
+            return await asyncio.gather(*(batcher.submit(i) for i in range(10)))
+
+        self.assertEqual(asyncio.run(main()), [i * 2 for i in range(10)])
+        self.assertEqual(sizes, [4, 4, 2])
+
+    def test_batch_error_fails_every_item_in_the_batch(self):
+        batcher = MicroBatcher(double, max_batch=4, max_latency_ms=50)
+
+        async def main():
+            results = await asyncio.gather(
+                batcher.submit(1), batcher.submit("bad"), batcher.submit(3),
+                return_exceptions=True
+            )
+            # The worker must survive the failed batch
+            return results, await batcher.submit(5)
+
+        results, after = asyncio.run(main())
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(after, 10)
+
+    def test_shared_across_threads_with_their_own_loops(self):
+        batcher = MicroBatcher(double, max_batch=4, max_latency_ms=5)
+        errors = []
+
+        def run():
+            try:
+                for _ in range(20):
+                    async def main():
+                        return await asyncio.wait_for(
+                            asyncio.gather(*(batcher.submit(i) for i in range(6))), timeout=5
+                        )
+                    self.assertEqual(asyncio.run(main()), [i * 2 for i in range(6)])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_forgets_finished_loops(self):
+        batcher = MicroBatcher(double, max_batch=4, max_latency_ms=5)
+        for i in range(5):
+            self.assertEqual(asyncio.run(batcher.submit(i)), i * 2)
+        gc.collect()
+        self.assertEqual(len(batcher._workers), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
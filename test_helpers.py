@@ -0,0 +1,96 @@
+import random
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+
+import summarizer
+from question_answering import _best_span, _softmax, extract_context
+
+
+class StubTokenizer:
+    """Treats every whitespace-separated integer in the text as one token id"""
+    def __call__(self, text, **kwargs):
+        return {"input_ids": [int(token) for token in text.split()]}
+
+    def decode(self, ids, **kwargs):
+        return " ".join(str(i) for i in ids)
+
+
+class BestSpanTest(unittest.TestCase):
+    def brute_force(self, start_logits, end_logits, offset, length, max_answer_len):
+        start_probs = _softmax(start_logits[offset:offset + length])
+        end_probs = _softmax(end_logits[offset:offset + length])
+        best = (0, 0, -1.0)
+        for s in range(length):
+            for e in range(s, min(s + max_answer_len, length)):
+                score = float(start_probs[s] * end_probs[e])
+                if score > best[2]:
+                    best = (s, e, score)
+        return best
+
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        for offset, length, max_answer_len in [(3, 20, 5), (0, 7, 1), (5, 12, 150), (2, 40, 15)]:
+            for _ in range(20):
+                start_logits = rng.normal(size=offset + length + 4)
+                end_logits = rng.normal(size=offset + length + 4)
+                s, e, score = _best_span(start_logits, end_logits, offset, length, max_answer_len)
+                want_s, want_e, want_score = self.brute_force(
+                    start_logits, end_logits, offset, length, max_answer_len
+                )
+                self.assertEqual((s, e), (want_s, want_e))
+                self.assertAlmostEqual(score, want_score)
+
+    def test_empty_context(self):
+        self.assertEqual(_best_span(np.zeros(4), np.zeros(4), 2, 0), (0, 0, 0.0))
+
+
+class ExtractContextTest(unittest.TestCase):
+    def test_chunk_offsets_slice_the_document(self):
+        rng = random.Random(0)
+        words = [f"word{i}" for i in range(2500)]
+        document_text = "\n\t " + "".join(
+            word + rng.choice([" ", "  ", "\n", "\t", " \n\n ", "\r\n"]) for word in words
+        )
+
+        chunks = extract_context(document_text)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertEqual(document_text[chunk['start']:chunk['end']], chunk['text'])
+            self.assertEqual(chunk['text'], chunk['text'].strip())
+        self.assertEqual(chunks[0]['text'].split()[0], words[0])
+        self.assertEqual(chunks[-1]['text'].split()[-1], words[-1])
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertLess(chunk['start'], previous['end'])
+
+    def test_empty_document(self):
+        self.assertEqual(extract_context("  \n "), [])
+
+
+class SplitIntoWindowsTest(unittest.TestCase):
+    def windows(self, n, max_input, overlap):
+        stub = SimpleNamespace(tokenizer=StubTokenizer())
+        text = " ".join(str(i) for i in range(n))
+        with mock.patch.object(summarizer, "summarizer", stub):
+            windows = summarizer.split_into_windows(text, max_input=max_input, overlap=overlap)
+        return [[int(token) for token in window.split()] for window in windows]
+
+    def test_short_text_is_one_window(self):
+        self.assertEqual(self.windows(50, 100, 10), [list(range(50))])
+
+    def test_windows_cover_every_token_and_overlap(self):
+        for n, max_input, overlap in [(101, 100, 10), (1000, 100, 10), (4321, 1000, 100), (250, 60, 59)]:
+            windows = self.windows(n, max_input, overlap)
+            self.assertEqual(windows[0][0], 0)
+            self.assertEqual(windows[-1][-1], n - 1)
+            for window in windows:
+                self.assertLessEqual(len(window), max_input)
+                self.assertEqual(window, list(range(window[0], window[-1] + 1)))
+            for previous, window in zip(windows, windows[1:]):
+                self.assertGreaterEqual(previous[-1] - window[0] + 1, overlap)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,56 @@
+import hashlib
+from io import BytesIO
+from typing import Iterator
+
+import pypdfium2 as pdfium
+import torch
 from pdfminer.high_level import extract_text
 
+# Run models on the first CUDA GPU in half precision when one is available
+USE_CUDA = torch.cuda.is_available()
+DEVICE = 0 if USE_CUDA else -1
+DTYPE = torch.float16 if USE_CUDA else torch.float32
+
+def iter_pdf_pages(data: bytes) -> Iterator[str]:
+    """Yield the text of each PDF page, closing PDFium's page handles as it goes"""
+    pdf = pdfium.PdfDocument(data)
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            try:
+                yield textpage.get_text_range()
+            finally:
+                textpage.close()
+                page.close()
+    finally:
+        pdf.close()
+
+def extract_text_from_pdf(data: bytes) -> str:
+    """
+    Extract PDF text with PDFium, falling back to the slower pdfminer
+    for files PDFium can't open or returns no text for
+    """
+    try:
+        text = "\n".join(iter_pdf_pages(data))
+    except pdfium.PdfiumError as e:
+        print(f"PDFium could not read the PDF, falling back to pdfminer: {e}")
+        text = ""
+    
+    if text.strip():
+        return text
+    return extract_text(BytesIO(data))
+
 def extract_text_from_file(uploaded_file):
     if uploaded_file.name.endswith('.pdf'):
         
-        with open("temp_uploaded.pdf", "wb") as f:
-            f.write(uploaded_file.read())
-        return extract_text("temp_uploaded.pdf")
+        return extract_text_from_pdf(uploaded_file.read())
 
     elif uploaded_file.name.endswith('.txt'):
         return uploaded_file.read().decode("utf-8")
 
     else:
         return "Unsupported file type."
+
+def document_hash(text: str) -> bytes:
+    """Short digest of a document, used as a cache key instead of the full text"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()